@@ -0,0 +1,121 @@
+import json
+from hashlib import md5
+
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.text import compress_string
+from recipes.cache import USER, get_versions
+from rest_framework.renderers import JSONRenderer
+
+rendered_catalogs = {}
+
+
+def accepts_gzip(request):
+    return "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified для list и retrieve по версиям данных.
+
+    Валидаторы строятся только из версий в кэше, поэтому на неизменённый
+    ресурс ответ 304 отдаётся без запросов к базе и сериализации.
+    """
+
+    version_names = ()
+    conditional_per_user = False
+
+    def get_version_names(self):
+        return self.version_names
+
+    def get_etag_variant(self, request):
+        """Отличие представления ответа, не видное по URL и формату,
+        например сжатие тела; пустое, если его нет.
+
+        Миксины, меняющие представление, переопределяют метод. Они могут
+        стоять в MRO после этого миксина, поэтому вызов передаётся дальше.
+        """
+        parent = getattr(super(), "get_etag_variant", None)
+        return None if parent is None else parent(request)
+
+    def get_validators(self, request):
+        names = list(self.get_version_names())
+        if self.conditional_per_user and request.user.is_authenticated:
+            names.append(USER.format(request.user.pk))
+        versions = get_versions(names)
+        raw = json.dumps(
+            [
+                request.get_full_path(),
+                request.accepted_renderer.format,
+                self.get_etag_variant(request),
+                self.conditional_per_user and request.user.pk,
+                sorted(versions.items()),
+            ]
+        )
+        etag = quote_etag(md5(raw.encode("utf-8")).hexdigest())
+        return etag, max(versions.values()) // 10 ** 9
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if 200 <= response.status_code < 300 or response.status_code == 304:
+            response["ETag"] = etag
+            response["Last-Modified"] = http_date(last_modified)
+        if self.conditional_per_user:
+            patch_vary_headers(response, ("Authorization",))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+
+class RenderedCatalogMixin:
+    """Полный список объектов, заранее отрендеренный в JSON и gzip.
+
+    Готовые байты хранятся в памяти процесса под версиями из
+    get_version_names и отдаются без обращения к базе и сериализатора.
+    """
+
+    def get_rendered_catalog(self, gzipped):
+        names = tuple(self.get_version_names())
+        versions = get_versions(names)
+        rendered = rendered_catalogs.get(names)
+        if rendered is None or rendered[0] != versions:
+            serializer = self.get_serializer(self.get_queryset(), many=True)
+            body = JSONRenderer().render(serializer.data)
+            rendered = (versions, body, compress_string(body))
+            rendered_catalogs[names] = rendered
+        return rendered[2] if gzipped else rendered[1]
+
+    def serves_catalog(self, request):
+        return (
+            not request.query_params
+            and request.accepted_renderer.format == "json"
+        )
+
+    def get_etag_variant(self, request):
+        return self.serves_catalog(request) and accepts_gzip(request)
+
+    def list(self, request, *args, **kwargs):
+        if not self.serves_catalog(request):
+            return super().list(request, *args, **kwargs)
+        gzipped = accepts_gzip(request)
+        response = HttpResponse(
+            self.get_rendered_catalog(gzipped),
+            content_type="application/json",
+        )
+        if gzipped:
+            response["Content-Encoding"] = "gzip"
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
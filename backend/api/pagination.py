@@ -1,6 +1,256 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from recipes.cache import get_version
+from recipes.signals import COUNTS
+from recipes.timeline import recipe_keys
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .utils import positive_int
+
+
+class CountCachingPaginator(Paginator):
+    """Paginator, берущий общее число объектов из кэша.
+
+    Для нефильтрованной таблицы PostgreSQL, число строк в которой больше
+    PAGINATION_ESTIMATE_THRESHOLD, используется оценка планировщика.
+    """
+
+    def __init__(self, object_list, per_page, count_key=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+
+    def get_estimate(self):
+        threshold = settings.PAGINATION_ESTIMATE_THRESHOLD
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if (
+            not threshold
+            or connection.vendor != "postgresql"
+            or queryset.query.where
+        ):
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE relname = %s",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if row is None or row[0] < threshold:
+            return None
+        return int(row[0])
+
+    @cached_property
+    def count(self):
+        if self.count_key is None:
+            return super().count
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.get_estimate()
+            if count is None:
+                count = super().count
+            cache.set(
+                self.count_key,
+                count,
+                settings.PAGINATION_COUNT_CACHE_TIMEOUT,
+            )
+        return count
+
+
+class KeysetPagination(BasePagination):
+    """Постраничный вывод по ключу без OFFSET и COUNT(*).
+
+    Курсор хранит значения полей сортировки последнего объекта страницы,
+    следующая страница выбирается условием «строго после» этого ключа.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    ordering = ("-pub_date", "-id")
+    invalid_cursor_message = "Неверный курсор"
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+
+    def get_ordering(self, view):
+        return getattr(view, "keyset_ordering", self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            return positive_int(
+                request.query_params[self.page_size_query_param]
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def decode_cursor(self, request, model):
+        """Значения полей сортировки из курсора, приведённые к типам
+        полей model."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            values = json.loads(b64decode(encoded.encode("ascii")))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(
+            self.ordering
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            return [
+                model._meta.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (DjangoValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance):
+        # isoformat вместо DjangoJSONEncoder, который отбрасывает
+        # микросекунды и пропускал бы рецепты внутри одной миллисекунды
+        values = [
+            getattr(instance, field.lstrip("-")) for field in self.ordering
+        ]
+        values = [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in values
+        ]
+        encoded = json.dumps(values)
+        return b64encode(encoded.encode("utf-8")).decode("ascii")
+
+    def get_keyset_filter(self, values):
+        """Лексикографическое условие (a, b, ...) «после» values."""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= equal & Q(**{f"{name}__{lookup}": value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(view)
+        page_size = self.get_page_size(request)
+        values = self.decode_cursor(request, queryset.model)
+        queryset = queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_filter(values))
+        results = list(queryset[:page_size + 1])
+        self.page = results[:page_size]
+        self.has_next = len(results) > page_size
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+class TimelinePagination(KeysetPagination):
+    """Постраничный вывод ленты подписок с тем же курсором, что
+    у KeysetPagination; порядок рецептов задаёт recipe_keys."""
+
+    def __init__(self):
+        super().__init__(api_settings.PAGE_SIZE)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        keys = recipe_keys(
+            request.user,
+            self.decode_cursor(request, queryset.model),
+            page_size + 1,
+        )
+        self.has_next = len(keys) > page_size
+        recipe_ids = [pk for _, pk in keys[:page_size]]
+        recipes = queryset.in_bulk(recipe_ids)
+        self.page = [recipes[pk] for pk in recipe_ids if pk in recipes]
+        return self.page
 
 
 class CustomPageNumberPagination(PageNumberPagination):
     page_size_query_param = "limit"
     page_query_description = "Количество объектов на странице"
+    pagination_query_param = "pagination"
+    keyset_pagination_class = KeysetPagination
+    user_dependent_params = ("is_favorited", "is_in_shopping_cart")
+
+    def get_count_cache_key(self, request, view):
+        """Ключ кэша для числа объектов, не зависящий от номера страницы,
+        размера страницы и порядка параметров фильтрации."""
+        excluded = (self.page_query_param, self.page_size_query_param)
+        params = sorted(
+            (key, sorted(values))
+            for key, values in request.query_params.lists()
+            if key not in excluded
+        )
+        per_user = getattr(view, "count_per_user", False) or any(
+            key in self.user_dependent_params for key, _ in params
+        )
+        raw = json.dumps(
+            [request.path, params, per_user and request.user.pk]
+        )
+        digest = md5(raw.encode("utf-8")).hexdigest()
+        return f"count:{get_version(COUNTS)}:{digest}"
+
+    def use_keyset(self, request, queryset, keyset, view):
+        """Курсор по запросу клиента, если он не меняет порядок выдачи.
+
+        Выдача с собственной сортировкой (например, поиск по
+        релевантности) курсором по дате не продолжается и выводится
+        по номерам страниц.
+        """
+        ordering = tuple(queryset.query.order_by)
+        return (
+            request.query_params.get(self.pagination_query_param) == "cursor"
+            or keyset.cursor_query_param in request.query_params
+        ) and ordering in ((), tuple(keyset.get_ordering(view)))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if not isinstance(queryset, QuerySet):
+            return super().paginate_queryset(queryset, request, view)
+        keyset = self.keyset_pagination_class(self.page_size)
+        if self.use_keyset(request, queryset, keyset, view):
+            self.keyset = keyset
+            return keyset.paginate_queryset(queryset, request, view)
+        self.django_paginator_class = partial(
+            CountCachingPaginator,
+            count_key=self.get_count_cache_key(request, view),
+        )
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -1,29 +1,70 @@
+import json
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.db.models import Manager, prefetch_related_objects
+from django.http import QueryDict
 from djoser.serializers import UserSerializer as DjoserUserSerializer
 from drf_extra_fields.fields import Base64ImageField
-from recipes.models import (FavoriteRecipe, Ingredient, IngredientInRecipe,
-                            Recipe, ShoppingList, Tag)
+from recipes import cart
+from recipes.cache import (RECIPE, RECIPES, contains, favorites, get_versions,
+                           invalidate_recipe_ingredients, shopping_cart)
+from recipes.images import VARIANTS, has_variants
+from recipes.models import (RECIPE_PAGE_FIELDS, Ingredient, IngredientInRecipe,
+                            Recipe, Tag)
 from rest_framework import serializers, status
 from rest_framework.exceptions import ValidationError
-from rest_framework.fields import SerializerMethodField
-from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField
+from rest_framework.fields import ImageField, SerializerMethodField
+from rest_framework.serializers import ModelSerializer
 from users.models import Subscription, User
 
 
+def get_following(context):
+    """id авторов, на которых подписан пользователь; загружаются один
+    раз на запрос."""
+    if "following" not in context:
+        user = context["request"].user
+        context["following"] = (
+            set()
+            if user.is_anonymous
+            else set(
+                Subscription.objects.filter(subscriber=user).values_list(
+                    "author_id", flat=True
+                )
+            )
+        )
+    return context["following"]
+
+
 class UserSerializer(DjoserUserSerializer):
     """Сериализатор ползователя"""
 
-    is_subscribed = serializers.BooleanField(default=False)
+    is_subscribed = SerializerMethodField()
 
     class Meta(DjoserUserSerializer.Meta):
         fields = DjoserUserSerializer.Meta.fields + ("is_subscribed",)
 
+    def get_is_subscribed(self, obj):
+        """Берётся из аннотации запроса, если она есть, иначе из набора
+        подписок пользователя."""
+        if hasattr(obj, "is_subscribed"):
+            return obj.is_subscribed
+        request = self.context.get("request")
+        if request is None or request.user == obj:
+            return False
+        return obj.id in get_following(self.context)
+
 
 class UserFollowSerializer(serializers.ModelSerializer):
     """Сериализатор подписчика"""
 
     is_subscribed = serializers.BooleanField(default=True)
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.IntegerField(default=0)
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = User
@@ -39,10 +80,31 @@ class UserFollowSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ("email", "username", "first_name", "last_name")
 
+    @staticmethod
+    def get_context(request, authors, recipes_limit=None):
+        """Контекст с рецептами авторов, выбранными одним запросом.
+
+        authors должны быть аннотированы числом рецептов recipes_count.
+        """
+        recipes = Recipe.objects.filter(
+            author_id__in=[author.id for author in authors]
+        )
+        if recipes_limit is None:
+            recipes = recipes.only(
+                *RECIPE_PAGE_FIELDS, "author_id"
+            ).order_by("author_id", "-pub_date", "-id")
+        else:
+            recipes = recipes.latest_per_author(recipes_limit)
+        by_author = defaultdict(list)
+        for recipe in recipes:
+            by_author[recipe.author_id].append(recipe)
+        return {"request": request, "recipes": by_author}
+
     def get_recipes(self, obj):
-        recipes = obj.recipes.all()
         serializer = RecipePageSerializer(
-            recipes, many=True, context=self.context
+            self.context["recipes"].get(obj.id, ()),
+            many=True,
+            context=self.context,
         )
         return serializer.data
 
@@ -83,7 +145,7 @@ class TagSerializer(serializers.ModelSerializer):
 class IngredientInRecipeSerializer(serializers.ModelSerializer):
     """Сериализатор игредиента при создании рецепта"""
 
-    id = PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    id = serializers.IntegerField()
     name = serializers.ReadOnlyField(source="ingredient.name")
     measurement_unit = serializers.ReadOnlyField(
         source="ingredient.measurement_unit"
@@ -95,22 +157,91 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data["id"] = instance.ingredient.id
+        data["id"] = instance.ingredient_id
         return data
 
 
+class RecipeImageField(Base64ImageField):
+    """Изображение в base64 внутри JSON или файлом из multipart/form-data.
+
+    Размер файла ограничен RECIPE_IMAGE_MAX_SIZE.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, UploadedFile):
+            image = ImageField.to_internal_value(self, data)
+        else:
+            image = super().to_internal_value(data)
+        if image is not None and image.size > settings.RECIPE_IMAGE_MAX_SIZE:
+            raise ValidationError(
+                "Размер изображения не должен превышать "
+                f"{settings.RECIPE_IMAGE_MAX_SIZE} байт"
+            )
+        return image
+
+
+class ImageVariantsField(serializers.Field):
+    """Ссылки на уменьшенные копии изображения рецепта.
+
+    Пока копии не построены, возвращается пустой словарь.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "*"
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        if not has_variants(recipe):
+            return {}
+        request = self.context.get("request")
+        return {
+            variant: {
+                extension: request.build_absolute_uri(
+                    default_storage.url(name)
+                )
+                for extension, name in recipe.image_variants[variant].items()
+            }
+            for variant in VARIANTS
+        }
+
+
 class RecipePageSerializer(ModelSerializer):
     """Сериализатор для отображения рецептов на странице подписок."""
 
     image = Base64ImageField()
+    images = ImageVariantsField()
 
     class Meta:
         model = Recipe
-        fields = ("id", "name", "image", "cooking_time")
+        fields = ("id", "name", "image", "images", "cooking_time")
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    """Список id рецептов для массового добавления или удаления."""
+
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=settings.RECIPE_BATCH_LIMIT,
+    )
+
+
+class RecipeListSerializer(serializers.ListSerializer):
+    """Список рецептов, собираемый из кэша одним обращением."""
+
+    def to_representation(self, data):
+        recipes = data.all() if isinstance(data, Manager) else data
+        return self.child.to_representation_many(list(recipes))
 
 
 class RecipeReadSerializer(ModelSerializer):
-    """Сериализатор для получения рецептов."""
+    """Сериализатор для получения рецептов.
+
+    Общая для всех пользователей часть рецепта кэшируется по id и версии
+    рецепта, признаки избранного, списка покупок и подписки на автора
+    подставляются для каждого запроса.
+    """
 
     tags = TagSerializer(many=True, read_only=True)
     author = UserSerializer(read_only=True)
@@ -118,6 +249,7 @@ class RecipeReadSerializer(ModelSerializer):
         source="recipeingredients", many=True
     )
     image = Base64ImageField()
+    images = ImageVariantsField()
     is_favorited = SerializerMethodField(read_only=True)
     is_in_shopping_cart = SerializerMethodField(read_only=True)
 
@@ -132,34 +264,82 @@ class RecipeReadSerializer(ModelSerializer):
             "is_in_shopping_cart",
             "name",
             "image",
+            "images",
             "text",
             "cooking_time",
         )
+        list_serializer_class = RecipeListSerializer
+
+    def get_fragment_keys(self, recipes):
+        names = [RECIPE.format(recipe.id) for recipe in recipes]
+        versions = get_versions(names + [RECIPES])
+        host = self.context["request"].get_host()
+        return {
+            recipe.id: (
+                f"recipe_fragment:{host}:{versions[RECIPES]}:"
+                f"{recipe.id}:{versions[name]}"
+            )
+            for recipe, name in zip(recipes, names)
+        }
+
+    def to_representation(self, instance):
+        return self.to_representation_many([instance])[0]
+
+    def to_representation_many(self, recipes):
+        keys = self.get_fragment_keys(recipes)
+        fragments = cache.get_many(keys.values())
+        missing = [
+            recipe for recipe in recipes if keys[recipe.id] not in fragments
+        ]
+        if missing:
+            prefetch_related_objects(
+                missing, *Recipe.objects.related_lookups()
+            )
+            rendered = {
+                keys[recipe.id]: super(
+                    RecipeReadSerializer, self
+                ).to_representation(recipe)
+                for recipe in missing
+            }
+            cache.set_many(rendered, settings.RECIPE_FRAGMENT_CACHE_TIMEOUT)
+            fragments.update(rendered)
+        return [
+            self.add_user_fields(fragments[keys[recipe.id]], recipe)
+            for recipe in recipes
+        ]
+
+    def add_user_fields(self, fragment, recipe):
+        data = fragment.copy()
+        data["is_favorited"] = self.get_is_favorited(recipe)
+        data["is_in_shopping_cart"] = self.get_is_in_shopping_cart(recipe)
+        if data["author"] is not None:
+            data["author"] = data["author"].copy()
+            data["author"]["is_subscribed"] = (
+                recipe.author_id in get_following(self.context)
+            )
+        return data
+
+    def get_recipe_ids(self, membership):
+        """id рецептов пользователя, загруженные один раз на запрос."""
+        if membership.prefix not in self.context:
+            user = self.context["request"].user
+            self.context[membership.prefix] = membership.get(user)
+        return self.context[membership.prefix]
 
     def get_is_favorited(self, obj):
-        user = self.context["request"].user
-        return (
-            not user.is_anonymous
-            and FavoriteRecipe.objects.filter(user=user, recipe=obj).exists()
-        )
+        return contains(self.get_recipe_ids(favorites), obj.id)
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context["request"].user
-        return (
-            not user.is_anonymous
-            and ShoppingList.objects.filter(user=user, recipe=obj).exists()
-        )
+        return contains(self.get_recipe_ids(shopping_cart), obj.id)
 
 
 class RecipeCreateSerializer(ModelSerializer):
     """Сериализатор для создания рецептов"""
 
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True
-    )
+    tags = serializers.ListField(child=serializers.IntegerField())
     author = UserSerializer(read_only=True)
     ingredients = IngredientInRecipeSerializer(many=True)
-    image = Base64ImageField()
+    image = RecipeImageField()
 
     class Meta:
         model = Recipe
@@ -174,36 +354,129 @@ class RecipeCreateSerializer(ModelSerializer):
             "cooking_time",
         )
 
+    def to_internal_value(self, data):
+        """В multipart/form-data ингредиенты передаются JSON-строкой."""
+        if isinstance(data, QueryDict) and "ingredients" in data:
+            tags = data.getlist("tags")
+            data = data.dict()
+            if "tags" in data:
+                data["tags"] = tags
+            try:
+                data["ingredients"] = json.loads(data["ingredients"])
+            except ValueError:
+                raise ValidationError(
+                    {"ingredients": "Ожидается JSON-список ингредиентов"}
+                )
+        return super().to_internal_value(data)
+
     def to_representation(self, instance):
         request = self.context.get("request")
         context = {"request": request}
         return RecipeReadSerializer(instance, context=context).data
 
+    def validate_tags(self, tags):
+        existing = set(
+            Tag.objects.filter(id__in=tags).values_list("id", flat=True)
+        )
+        missing = [pk for pk in tags if pk not in existing]
+        if missing:
+            raise ValidationError(f"Тегов не существует: {missing}")
+        return list(dict.fromkeys(tags))
+
+    def validate_ingredients(self, ingredients):
+        ids = [ingredient["id"] for ingredient in ingredients]
+        repeated = [pk for pk, count in Counter(ids).items() if count > 1]
+        if repeated:
+            raise ValidationError(f"Ингредиенты повторяются: {repeated}")
+        existing = set(
+            Ingredient.objects.filter(id__in=ids).values_list("id", flat=True)
+        )
+        missing = [pk for pk in ids if pk not in existing]
+        if missing:
+            raise ValidationError(f"Ингредиентов не существует: {missing}")
+        return ingredients
+
+    def create_ingredients(self, recipe, ingredients):
+        IngredientInRecipe.objects.bulk_create(
+            IngredientInRecipe(
+                recipe=recipe,
+                ingredient_id=ingredient["id"],
+                amount=ingredient["amount"],
+            )
+            for ingredient in ingredients
+        )
+        invalidate_recipe_ingredients(recipe.id)
+
+    @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop("tags")
         ingredients = validated_data.pop("ingredients")
         recipe = Recipe.objects.create(**validated_data)
         recipe.tags.set(tags)
-        for ingredient in ingredients:
-            IngredientInRecipe.objects.create(
-                recipe=recipe,
-                ingredient=ingredient.get("id"),
-                amount=ingredient.get("amount"),
-            )
+        self.create_ingredients(recipe, ingredients)
         return recipe
 
+    def update_tags(self, recipe, tags):
+        current = set(recipe.tags.values_list("id", flat=True))
+        new = set(tags)
+        if current - new:
+            recipe.tags.remove(*(current - new))
+        if new - current:
+            recipe.tags.add(*(new - current))
+
+    def update_ingredients(self, recipe, ingredients):
+        """Применяет к ингредиентам рецепта только отличия от текущих:
+        не больше одного удаления, одного обновления и одной вставки."""
+        current = {
+            row.ingredient_id: row
+            for row in recipe.recipeingredients.all()
+        }
+        amounts = {
+            ingredient["id"]: ingredient["amount"]
+            for ingredient in ingredients
+        }
+        removed = current.keys() - amounts.keys()
+        added = [
+            {"id": pk, "amount": amount}
+            for pk, amount in amounts.items()
+            if pk not in current
+        ]
+        changed = []
+        deltas = {
+            ingredient["id"]: ingredient["amount"] for ingredient in added
+        }
+        for pk, row in current.items():
+            if pk in amounts and row.amount != amounts[pk]:
+                deltas[pk] = amounts[pk] - row.amount
+                row.amount = amounts[pk]
+                changed.append(row)
+        if removed:
+            IngredientInRecipe.objects.filter(
+                recipe=recipe, ingredient_id__in=removed
+            ).delete()
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ("amount",))
+        if added:
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe=recipe,
+                    ingredient_id=ingredient["id"],
+                    amount=ingredient["amount"],
+                )
+                for ingredient in added
+            )
+        if removed or changed or added:
+            invalidate_recipe_ingredients(recipe.id)
+        # Удалённые строки учитываются в списках покупок сигналами,
+        # массовые обновление и вставка сигналов не отправляют.
+        cart.change_amounts(recipe.id, deltas)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
         tags = validated_data.pop("tags", None)
         if tags is not None:
-            instance.tags.set(tags)
+            self.update_tags(instance, tags)
         ingredients = validated_data.pop("ingredients", None)
         if ingredients is not None:
-            instance.ingredients.clear()
-            for ingredient in ingredients:
-                amount = ingredient["amount"]
-                IngredientInRecipe.objects.update_or_create(
-                    recipe=instance,
-                    ingredient=ingredient.get("id"),
-                    defaults={"amount": amount},
-                )
+            self.update_ingredients(instance, ingredients)
         return super().update(instance, validated_data)
@@ -0,0 +1,291 @@
+from threading import Thread
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from recipes.cart import expected_totals, stored_totals
+from recipes.models import (FavoriteRecipe, Ingredient, IngredientInRecipe,
+                            Recipe, ShoppingList, Tag)
+from rest_framework.test import APIClient, APITestCase
+from users.models import User
+
+RECIPES_URL = "/api/recipes/"
+
+
+class RecipeListQueriesTest(APITestCase):
+    """Число запросов списка рецептов не зависит от размера страницы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="cook@example.com",
+            username="cook",
+            first_name="Повар",
+            last_name="Поваров",
+            password="password",
+        )
+        tags = [
+            Tag.objects.create(name=name, slug=slug, color=color)
+            for name, slug, color in (
+                ("Завтрак", "breakfast", "#E26C2D"),
+                ("Обед", "lunch", "#49B64E"),
+            )
+        ]
+        ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit="г")
+            for name in ("Мука", "Сахар", "Соль")
+        ]
+        for number in range(6):
+            recipe = Recipe.objects.create(
+                author=cls.user,
+                name=f"Рецепт {number}",
+                text="Описание",
+                image="recipes/images/recipe.png",
+                cooking_time=10,
+            )
+            recipe.tags.set(tags)
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe=recipe, ingredient=ingredient, amount=number + 1
+                )
+                for ingredient in ingredients
+            )
+            FavoriteRecipe.objects.create(user=cls.user, recipe=recipe)
+            ShoppingList.objects.create(user=cls.user, recipe=recipe)
+
+    def setUp(self):
+        # Версии в кэше меняются только после коммита, а TestCase
+        # откатывает транзакцию каждого теста
+        cache.clear()
+        self.client.force_authenticate(self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.json()
+
+    def assert_constant_queries(self, url):
+        # Первые запросы заполняют кэши версий, количества и индексы
+        for limit in (2, 6):
+            self.client.get(f"{url}limit={limit}")
+        queries, page = self.count_queries(f"{url}limit=2")
+        self.assertEqual(len(page["results"]), 2)
+        with self.assertNumQueries(queries):
+            response = self.client.get(f"{url}limit=6")
+        results = response.json()["results"]
+        self.assertEqual(len(results), 6)
+        for recipe in results:
+            self.assertTrue(recipe["is_favorited"])
+            self.assertTrue(recipe["is_in_shopping_cart"])
+            self.assertEqual(len(recipe["tags"]), 2)
+            self.assertEqual(len(recipe["ingredients"]), 3)
+
+    def test_list_queries_do_not_depend_on_limit(self):
+        self.assert_constant_queries(f"{RECIPES_URL}?")
+
+    def test_filtered_list_queries_do_not_depend_on_limit(self):
+        self.assert_constant_queries(f"{RECIPES_URL}?author={self.user.id}&")
+
+
+class RecipeTagFilterTest(APITestCase):
+    """Рецепт с несколькими выбранными тегами попадает в выдачу один раз."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="cook@example.com",
+            username="cook",
+            first_name="Повар",
+            last_name="Поваров",
+            password="password",
+        )
+        breakfast = Tag.objects.create(
+            name="Завтрак", slug="breakfast", color="#E26C2D"
+        )
+        lunch = Tag.objects.create(name="Обед", slug="lunch", color="#49B64E")
+        cls.recipes = {}
+        for name, tags in (
+            ("both", (breakfast, lunch)),
+            ("breakfast", (breakfast,)),
+            ("lunch", (lunch,)),
+            ("untagged", ()),
+        ):
+            recipe = Recipe.objects.create(
+                author=cls.user,
+                name=name,
+                text="Описание",
+                image="recipes/images/recipe.png",
+                cooking_time=10,
+            )
+            recipe.tags.set(tags)
+            cls.recipes[name] = recipe.id
+
+    def setUp(self):
+        cache.clear()
+
+    def assert_tagged_once(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        ids = [recipe["id"] for recipe in data["results"]]
+        expected = {
+            self.recipes[name] for name in ("both", "breakfast", "lunch")
+        }
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), expected)
+        self.assertEqual(data["count"], len(expected))
+
+    def test_index_multiple_tags(self):
+        self.assert_tagged_once(f"{RECIPES_URL}?tags=breakfast&tags=lunch")
+
+    def test_filterset_multiple_tags(self):
+        self.assert_tagged_once(
+            f"{RECIPES_URL}?tags=breakfast&tags=lunch&author={self.user.id}"
+        )
+
+    def test_single_tag(self):
+        response = self.client.get(f"{RECIPES_URL}?tags=lunch&limit=1")
+        data = response.json()
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(len(data["results"]), 1)
+
+
+class ToggleQueriesTest(APITestCase):
+    """Добавление и удаление рецепта - по одному запросу на изменение,
+    плюс пересчёт сумм для списка покупок."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="cook@example.com",
+            username="cook",
+            first_name="Повар",
+            last_name="Поваров",
+            password="password",
+        )
+        ingredient = Ingredient.objects.create(
+            name="Мука", measurement_unit="г"
+        )
+        cls.recipe = Recipe.objects.create(
+            author=cls.user,
+            name="Рецепт",
+            text="Описание",
+            image="recipes/images/recipe.png",
+            cooking_time=10,
+        )
+        IngredientInRecipe.objects.create(
+            recipe=cls.recipe, ingredient=ingredient, amount=100
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.user)
+
+    def assert_toggle_queries(self, action, cart_queries):
+        url = f"{RECIPES_URL}{self.recipe.id}/{action}/"
+        # Рецепт, SAVEPOINT, INSERT, RELEASE SAVEPOINT
+        with self.assertNumQueries(4 + cart_queries):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(4):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 400)
+        # SAVEPOINT, DELETE, RELEASE SAVEPOINT
+        with self.assertNumQueries(3 + cart_queries):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, 204)
+
+    def test_favorite_queries(self):
+        self.assert_toggle_queries("favorite", 0)
+
+    def test_shopping_cart_queries(self):
+        # Суммы ингредиентов списка покупок меняются одним запросом
+        self.assert_toggle_queries("shopping_cart", 1)
+
+
+class ToggleConcurrencyTest(TransactionTestCase):
+    """Параллельные добавления и удаления одного рецепта не приводят
+    к ошибкам сервера и расхождениям сумм списка покупок.
+
+    Потокам нужна общая база: на SQLite в памяти тест пропускается.
+    """
+
+    THREADS_PER_USER = 2
+    ROUNDS = 5
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("Общая база SQLite в памяти блокируется потоками")
+        author = User.objects.create_user(
+            email="author@example.com",
+            username="author",
+            first_name="Автор",
+            last_name="Авторов",
+            password="password",
+        )
+        ingredient = Ingredient.objects.create(
+            name="Мука", measurement_unit="г"
+        )
+        self.recipe_ids = []
+        # Изображений нет на диске, варианты не строятся
+        with mock.patch("recipes.signals.schedule_variants"):
+            for number in range(3):
+                recipe = Recipe.objects.create(
+                    author=author,
+                    name=f"Рецепт {number}",
+                    text="Описание",
+                    image="recipes/images/recipe.png",
+                    cooking_time=10,
+                )
+                IngredientInRecipe.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=100
+                )
+                self.recipe_ids.append(recipe.id)
+        self.users = [
+            User.objects.create_user(
+                email=f"user{number}@example.com",
+                username=f"user{number}",
+                first_name="Пользователь",
+                last_name="Пользователев",
+                password="password",
+            )
+            for number in range(2)
+        ]
+
+    def toggle(self, user, statuses):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            for _ in range(self.ROUNDS):
+                for recipe_id in self.recipe_ids:
+                    for action in ("favorite", "shopping_cart"):
+                        url = f"{RECIPES_URL}{recipe_id}/{action}/"
+                        for method in ("post", "post", "delete", "post"):
+                            response = getattr(client, method)(url)
+                            statuses.append(response.status_code)
+        finally:
+            connections.close_all()
+
+    def test_concurrent_toggles(self):
+        statuses = []
+        threads = [
+            Thread(target=self.toggle, args=(user, statuses))
+            for user in self.users
+            for _ in range(self.THREADS_PER_USER)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            len(statuses),
+            len(threads) * self.ROUNDS * len(self.recipe_ids) * 2 * 4,
+        )
+        self.assertLessEqual(set(statuses), {201, 204, 400})
+        self.assertEqual(
+            list(stored_totals()),
+            [(*key, total) for *key, total in expected_totals()],
+        )
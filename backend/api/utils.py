@@ -1,23 +1,96 @@
-from django.db.models.aggregates import Sum
-from django.http import HttpResponse
-from recipes.models import IngredientInRecipe
+import csv
+import json
 
+from django.http import StreamingHttpResponse
+from recipes.models import ShoppingListIngredient
+from rest_framework.exceptions import ValidationError
 
-def download_shopping_cart(self, request):
-    ingredients = (
-        IngredientInRecipe.objects.filter(
-            recipe__shopping_list__user=request.user)
-        .values("ingredient__name", "ingredient__measurement_unit")
-        .annotate(amount=Sum("amount"))
+EXPORT_TYPE_PARAM = "type"
+EXPORT_CHUNK_SIZE = 500
+CSV_HEADER = ("Ингредиент", "Единица измерения", "Количество")
+
+
+class Echo:
+    """Файловый объект для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def positive_int(value):
+    """Положительное целое из строки параметра запроса, иначе ValueError."""
+    number = int(value)
+    if number <= 0:
+        raise ValueError(value)
+    return number
+
+
+def render_txt(rows):
+    for name, measurement_unit, amount in rows:
+        yield f"•  {name}({measurement_unit})— {amount}\n"
+
+
+def render_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def render_json(rows):
+    separator = "["
+    for name, measurement_unit, amount in rows:
+        yield separator + json.dumps(
+            {
+                "name": name,
+                "measurement_unit": measurement_unit,
+                "amount": amount,
+            },
+            ensure_ascii=False,
+        )
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+EXPORT_TYPES = {
+    "txt": ("text/plain; charset=UTF-8", render_txt),
+    "csv": ("text/csv; charset=UTF-8", render_csv),
+    "json": ("application/json; charset=UTF-8", render_json),
+}
+
+
+def shopping_cart_rows(user):
+    """Суммы ингредиентов из корзины по алфавиту.
+
+    Строки читаются серверным курсором по мере отправки ответа.
+    """
+    return (
+        ShoppingListIngredient.objects.filter(user=user, amount__gt=0)
+        .values_list(
+            "ingredient__name", "ingredient__measurement_unit", "amount"
+        )
+        .order_by("ingredient__name", "ingredient__measurement_unit")
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
     )
-    text = ""
-    for ingredient in ingredients:
-        text += (
-            f'•  {ingredient["ingredient__name"]}'
-            f'({ingredient["ingredient__measurement_unit"]})'
-            f'— {ingredient["amount"]}\n'
+
+
+def download_shopping_cart(self, request):
+    export_type = request.query_params.get(EXPORT_TYPE_PARAM, "txt")
+    if export_type not in EXPORT_TYPES:
+        raise ValidationError(
+            {
+                EXPORT_TYPE_PARAM: "Допустимые форматы: "
+                + ", ".join(EXPORT_TYPES)
+            }
+        )
+    content_type, render = EXPORT_TYPES[export_type]
+    headers = {
+        "Content-Disposition": (
+            f"attachment; filename=shopping_cart.{export_type}"
         )
-    headers = {"Content-Disposition": "attchment; filename=shoping_cart.txt"}
-    return HttpResponse(
-        text, content_type="text/plain; charset=UTF-8", headers=headers
+    }
+    return StreamingHttpResponse(
+        render(shopping_cart_rows(request.user)),
+        content_type=content_type,
+        headers=headers,
     )
@@ -1,37 +1,85 @@
+from django.db.models import Count, Exists, OuterRef, QuerySet
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
+from recipes.cache import INGREDIENTS, RECIPE, RECIPE_LIST, RECIPES, TAGS
 from recipes.filters import IngredientSearch, RecipeFilter
-from recipes.models import (FavoriteRecipe, Ingredient, Recipe, ShoppingList,
-                            Tag)
+from recipes.models import (RECIPE_PAGE_FIELDS, FavoriteRecipe, Ingredient,
+                            Recipe, ShoppingList, Tag)
+from recipes.search import recipe_ingredient_index, recipe_list_index
+from recipes.signals import bulk_delete, bulk_insert
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
 from rest_framework.response import Response
 from users.models import Subscription, User
 
-from .pagination import CustomPageNumberPagination
+from .mixins import ConditionalGetMixin, RenderedCatalogMixin
+from .pagination import CustomPageNumberPagination, TimelinePagination
 from .permissions import IsAuthorOrAdminOrReadOnly
 from .serializers import (IngredientSerailizer, RecipeCreateSerializer,
-                          RecipePageSerializer, RecipeReadSerializer,
-                          TagSerializer, UserFollowSerializer, UserSerializer)
-from .utils import download_shopping_cart
+                          RecipeIdsSerializer, RecipePageSerializer,
+                          RecipeReadSerializer, TagSerializer,
+                          UserFollowSerializer, UserSerializer)
+from .utils import download_shopping_cart, positive_int
+
+MATCH_MAX_MISSING = 2
+LISTING_PARAMS = {"tags", "page", "limit"}
 
 
 class UsersViewSet(UserViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     pagination_class = CustomPageNumberPagination
+    keyset_ordering = ("id",)
+    count_per_user = False
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        user = self.request.user
+        if self.action in ("list", "retrieve") and user.is_authenticated:
+            return queryset.annotate(
+                is_subscribed=Exists(
+                    Subscription.objects.filter(
+                        subscriber=user, author=OuterRef("pk")
+                    )
+                )
+            )
+        return queryset
+
+    def get_recipes_limit(self):
+        """Сколько рецептов каждого автора показывать, None - все."""
+        value = self.request.query_params.get("recipes_limit")
+        if value is None:
+            return None
+        try:
+            return positive_int(value)
+        except ValueError:
+            raise ValidationError(
+                {"recipes_limit": "Ожидается положительное целое число"}
+            )
 
     @action(
-        detail=False, methods=["get"], permission_classes=[IsAuthenticated]
+        detail=False,
+        methods=["get"],
+        permission_classes=[IsAuthenticated],
+        count_per_user=True,
     )
     def subscriptions(self, request):
         user = request.user
-        queryset = User.objects.filter(following__user=user)
+        queryset = (
+            User.objects.filter(author_subscriptions__subscriber=user)
+            .annotate(recipes_count=Count("recipes"))
+            .order_by("id")
+        )
         page = self.paginate_queryset(queryset)
         serializer = UserFollowSerializer(
-            page, many=True, context={"request": request}
+            page,
+            many=True,
+            context=UserFollowSerializer.get_context(
+                request, page, self.get_recipes_limit()
+            ),
         )
         return self.get_paginated_response(serializer.data)
 
@@ -42,45 +90,55 @@ class UsersViewSet(UserViewSet):
     )
     def subscribe(self, request, id):
         user = request.user
-        author = get_object_or_404(User, id=id)
+        author = get_object_or_404(
+            User.objects.annotate(recipes_count=Count("recipes")), id=id
+        )
 
         if request.method == "POST":
-            Subscription.objects.create(user=user, author=author)
+            Subscription.objects.create(subscriber=user, author=author)
             serializer = UserFollowSerializer(
-                author, context={"request": request}
+                author,
+                context=UserFollowSerializer.get_context(
+                    request, [author], self.get_recipes_limit()
+                ),
             )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if not Subscription.objects.filter(
-            user=user, author=author
+            subscriber=user, author=author
         ).exists():
             return Response(
                 {"errors": "Вы не подписаны"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
         subscription = get_object_or_404(
-            Subscription, user=user, author=author
+            Subscription, subscriber=user, author=author
         )
         subscription.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(
+    ConditionalGetMixin, RenderedCatalogMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerailizer
     permission_classes = (IsAuthorOrAdminOrReadOnly,)
     pagination_class = None
     filter_backends = (IngredientSearch,)
-    search_fields = ("^name",)
+    version_names = (INGREDIENTS,)
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(
+    ConditionalGetMixin, RenderedCatalogMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAuthorOrAdminOrReadOnly,)
     pagination_class = None
+    version_names = (TAGS,)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     pagination_class = CustomPageNumberPagination
     permission_classes = (IsAuthorOrAdminOrReadOnly,)
@@ -92,6 +150,34 @@ class RecipeViewSet(viewsets.ModelViewSet):
         "patch",
         "delete",
     )
+    conditional_per_user = True
+
+    def get_version_names(self):
+        if self.action == "retrieve":
+            return (RECIPES, RECIPE.format(self.kwargs["pk"]))
+        return (RECIPES, RECIPE_LIST)
+
+    def get_queryset(self):
+        return Recipe.objects.select_related("author").defer("search_vector")
+
+    def filter_queryset(self, queryset):
+        """Для списка всех рецептов или рецептов с тегами возвращает
+        упорядоченные id из индекса в памяти вместо запроса к базе."""
+        params = self.request.query_params
+        if self.action != "list" or set(params) - LISTING_PARAMS:
+            return super().filter_queryset(queryset)
+        recipe_ids = recipe_list_index.recipe_ids(params.getlist("tags"))
+        if recipe_ids is None:
+            return super().filter_queryset(queryset)
+        return recipe_ids
+
+    def paginate_queryset(self, queryset):
+        """Страница списка id превращается в рецепты одним запросом."""
+        page = super().paginate_queryset(queryset)
+        if page is None or isinstance(queryset, QuerySet):
+            return page
+        recipes = self.get_queryset().in_bulk(page)
+        return [recipes[pk] for pk in page if pk in recipes]
 
     def perform_create(self, serializer):
         return serializer.save(author=self.request.user)
@@ -104,69 +190,163 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def perform_update(self, serializer):
         serializer.save(author=self.request.user)
 
-    @action(
-        detail=True,
-        methods=["post", "delete"],
-        permission_classes=[IsAuthenticated],
-    )
-    def favorite(self, request, pk=None):
-        user = self.request.user
-        recipe = get_object_or_404(Recipe, pk=pk)
+    def toggle(self, request, pk, model, exists_error, missing_error):
+        """Добавляет рецепт одной вставкой или удаляет одним DELETE.
 
-        if self.request.method == "POST":
-            if FavoriteRecipe.objects.filter(
-                user=user, recipe=recipe
-            ).exists():
+        Повторное добавление распознаётся по пропущенной при конфликте
+        вставке, поэтому одновременные запросы не приводят к ошибке
+        сервера. Кэш сбрасывается один раз после коммита.
+        """
+        user = request.user
+        if request.method == "POST":
+            recipe = get_object_or_404(
+                Recipe.objects.only(*RECIPE_PAGE_FIELDS), pk=pk
+            )
+            if not bulk_insert(model, user.id, [recipe.id]):
                 return Response(
-                    {"errors": "Рецепт уже в избранном"},
+                    {"errors": exists_error},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            FavoriteRecipe.objects.create(user=user, recipe=recipe)
             serializer = RecipePageSerializer(
                 recipe, context={"request": request}
             )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
-        if not FavoriteRecipe.objects.filter(
-            user=user, recipe=recipe
-        ).exists():
+        try:
+            recipe_id = int(pk)
+        except ValueError:
+            raise NotFound()
+        if not bulk_delete(model, user.id, [recipe_id]):
+            get_object_or_404(Recipe.objects.only("id"), pk=pk)
             return Response(
-                {"errors": "Рецепта нет в избранном"},
+                {"errors": missing_error},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        favorite = get_object_or_404(FavoriteRecipe, user=user, recipe=recipe)
-        favorite.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        detail=True,
+        methods=["post", "delete"],
+        permission_classes=[IsAuthenticated],
+    )
+    def favorite(self, request, pk=None):
+        return self.toggle(
+            request,
+            pk,
+            FavoriteRecipe,
+            "Рецепт уже в избранном",
+            "Рецепта нет в избранном",
+        )
+
     @action(
         detail=True,
         methods=["post", "delete"],
         permission_classes=[IsAuthenticated],
     )
     def shopping_cart(self, request, pk=None):
-        user = self.request.user
-        recipe = get_object_or_404(Recipe, pk=pk)
+        return self.toggle(
+            request,
+            pk,
+            ShoppingList,
+            "Уже в списке",
+            "Рецепта нет в списке покупок",
+        )
 
-        if self.request.method == "POST":
-            if ShoppingList.objects.filter(user=user, recipe=recipe).exists():
-                return Response(
-                    {"errors": "Уже в списке"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            ShoppingList.objects.create(user=user, recipe=recipe)
-            serializer = RecipePageSerializer(
-                recipe, context={"request": request}
+    def change_many(self, request, model):
+        """Добавляет или удаляет набор рецептов одной вставкой или одним
+        удалением и возвращает результат для каждого id."""
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = list(dict.fromkeys(serializer.validated_data["recipes"]))
+        user = request.user
+        if request.method == "POST":
+            outcomes = {
+                pk: "exists"
+                for pk in Recipe.objects.filter(id__in=recipe_ids)
+                .values_list("id", flat=True)
+            }
+            outcomes.update(
+                (pk, "added")
+                for pk in bulk_insert(model, user.id, recipe_ids)
             )
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        if not ShoppingList.objects.filter(user=user, recipe=recipe).exists():
-            return Response(
-                {"errors": "Рецепта нет в списке покупок"},
-                status=status.HTTP_400_BAD_REQUEST,
+        else:
+            current = list(
+                model.objects.filter(
+                    user=user, recipe_id__in=recipe_ids
+                ).values_list("recipe_id", flat=True)
             )
-        shopping_cart = get_object_or_404(
-            ShoppingList, user=user, recipe=recipe
+            outcomes = {
+                pk: "removed" for pk in bulk_delete(model, user.id, current)
+            }
+        return Response(
+            {
+                "results": [
+                    {"id": pk, "status": outcomes.get(pk, "not_found")}
+                    for pk in recipe_ids
+                ]
+            }
         )
-        shopping_cart.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(
+        detail=False,
+        methods=["post", "delete"],
+        permission_classes=[IsAuthenticated],
+        url_path="favorite/batch",
+        url_name="favorite-batch",
+    )
+    def favorite_batch(self, request):
+        return self.change_many(request, FavoriteRecipe)
+
+    @action(
+        detail=False,
+        methods=["post", "delete"],
+        permission_classes=[IsAuthenticated],
+        url_path="shopping_cart/batch",
+        url_name="shopping-cart-batch",
+    )
+    def shopping_cart_batch(self, request):
+        return self.change_many(request, ShoppingList)
+
+    @action(detail=False, methods=["get"])
+    def match(self, request):
+        """Рецепты из имеющихся ингредиентов: сначала те, для которых есть
+        всё, затем с одним-двумя недостающими ингредиентами."""
+        try:
+            ingredient_ids = [
+                int(value)
+                for values in request.query_params.getlist("ingredients")
+                for value in values.split(",")
+                if value
+            ]
+            max_missing = int(
+                request.query_params.get("missing", MATCH_MAX_MISSING)
+            )
+        except ValueError:
+            raise ValidationError(
+                {"ingredients": "Ожидаются целые id ингредиентов"}
+            )
+        missing = dict(
+            recipe_ingredient_index.match(
+                ingredient_ids, min(max(max_missing, 0), MATCH_MAX_MISSING)
+            )
+        )
+        page = self.paginate_queryset(list(missing))
+        data = self.get_serializer(page, many=True).data
+        for item, recipe in zip(data, page):
+            item["missing"] = missing[recipe.id]
+        return self.get_paginated_response(data)
+
+    @action(
+        detail=False,
+        methods=["get"],
+        permission_classes=[IsAuthenticated],
+        pagination_class=TimelinePagination,
+    )
+    def timeline(self, request):
+        """Рецепты авторов, на которых подписан пользователь, от новых
+        к старым."""
+        page = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(
         detail=False, methods=["get"], permission_classes=[IsAuthenticated]
@@ -83,6 +83,32 @@ DATABASES = {
         'PORT': os.getenv('DB_PORT')
     }
 }
+# Тестовая база SQLite в файле, а не в памяти: тесты с потоками
+# обращаются к ней из нескольких соединений
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['TEST'] = {
+        'NAME': os.getenv('TEST_DB_NAME', default='test_db.sqlite3')
+    }
+
+# Кэш общий для всех процессов: версии данных, сбрасываемые сигналами,
+# должны видеть все воркеры gunicorn и management-команды. По умолчанию
+# memcached (сервис memcached в infra/docker-compose.yml). Запасной
+# вариант - CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache:
+# таблицу создаёт manage.py createcachetable, а каждое обращение к кэшу
+# становится запросом к базе.
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.memcached.PyMemcacheCache",
+        ),
+        "LOCATION": os.getenv("CACHE_LOCATION", default="127.0.0.1:11211"),
+    }
+}
+if CACHES["default"]["BACKEND"].endswith("DatabaseCache"):
+    CACHES["default"]["OPTIONS"] = {
+        "MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", default=100000))
+    }
 
 
 # Password validation
@@ -141,6 +167,44 @@ REST_FRAMEWORK = {
     "NON_FIELD_ERRORS_KEY": "errors",
 }
 
+# Время жизни кэша общего числа объектов в постраничной выдаче (секунды)
+PAGINATION_COUNT_CACHE_TIMEOUT = int(
+    os.getenv("PAGINATION_COUNT_CACHE_TIMEOUT", default=60)
+)
+
+# Размер таблицы, начиная с которого для нефильтрованной выдачи вместо
+# COUNT(*) берётся оценка планировщика PostgreSQL; 0 - выключено
+PAGINATION_ESTIMATE_THRESHOLD = int(
+    os.getenv("PAGINATION_ESTIMATE_THRESHOLD", default=0)
+)
+
+# Время жизни кэша id избранных рецептов и рецептов в списке покупок
+MEMBERSHIP_CACHE_TIMEOUT = int(
+    os.getenv("MEMBERSHIP_CACHE_TIMEOUT", default=60 * 60)
+)
+
+# Время жизни кэша общей для всех пользователей части рецепта
+RECIPE_FRAGMENT_CACHE_TIMEOUT = int(
+    os.getenv("RECIPE_FRAGMENT_CACHE_TIMEOUT", default=60 * 60 * 24)
+)
+
+# Число ингредиентов в ответе на поиск по началу названия
+INGREDIENT_SEARCH_LIMIT = int(os.getenv("INGREDIENT_SEARCH_LIMIT", default=20))
+
+# Число потоков, строящих уменьшенные копии изображений рецептов
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", default=2))
+
+# Сколько рецептов можно добавить в избранное или список покупок
+# одним запросом
+RECIPE_BATCH_LIMIT = int(os.getenv("RECIPE_BATCH_LIMIT", default=100))
+
+# Рецепты авторов, у которых подписчиков больше этого числа, не
+# раскладываются по лентам, а подмешиваются при чтении
+TIMELINE_FANOUT_LIMIT = int(os.getenv("TIMELINE_FANOUT_LIMIT", default=1000))
+
+# Сколько последних рецептов автора добавляется в ленту при подписке
+TIMELINE_BACKFILL = int(os.getenv("TIMELINE_BACKFILL", default=50))
+
 DJOSER = {
     "PERMISSIONS": {
         "user_list": ("rest_framework.permissions.AllowAny",),
@@ -155,6 +219,19 @@ DJOSER = {
     "HIDE_USERS": False,
 }
 
+# Загружаемые файлы пишутся во временный файл по частям, а не в память
+FILE_UPLOAD_HANDLERS = (
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+)
+
+# Максимальный размер изображения рецепта в байтах
+RECIPE_IMAGE_MAX_SIZE = int(
+    os.getenv("RECIPE_IMAGE_MAX_SIZE", default=10 * 2 ** 20)
+)
+
+# Медиафайлы именуются по хэшу содержимого и не перезаписываются
+DEFAULT_FILE_STORAGE = "recipes.storage.ContentAddressedStorage"
+
 MEDIA_URL = "media/"
 
 MEDIA_ROOT = os.path.join(BASE_DIR, MEDIA_URL)
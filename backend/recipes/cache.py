@@ -0,0 +1,203 @@
+from array import array
+from bisect import bisect_left
+from itertools import takewhile
+from threading import local
+from time import time_ns
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from .models import FavoriteRecipe, ShoppingList
+
+VERSION_KEY = "version:{}"
+CHANGES_KEY = "changes:{}"
+CHANGES_TIMEOUT = 24 * 60 * 60
+
+# Изменения кэша, отложенные до коммита транзакции текущего потока
+pending = local()
+
+
+RECIPES = "recipes"
+RECIPE = "recipe:{}"
+RECIPE_LIST = "recipe_list"
+# Меняется только при создании и удалении рецептов и смене их тегов
+RECIPE_ORDER = "recipe_order"
+TAGS = "tags"
+INGREDIENTS = "ingredients"
+USER = "user:{}"
+
+
+def get_version(name):
+    """Текущая версия набора данных name для построения ключей кэша."""
+    return cache.get_or_set(VERSION_KEY.format(name), time_ns, timeout=None)
+
+
+def get_versions(names):
+    """Версии нескольких наборов данных за одно обращение к кэшу."""
+    keys = {VERSION_KEY.format(name): name for name in names}
+    versions = cache.get_many(keys)
+    missing = {key: time_ns() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def bump_version(*names):
+    """Делает недействительными все ключи, построенные на версиях names.
+
+    Версия - время изменения в наносекундах: она же служит Last-Modified,
+    а потерянная из кэша версия не возвращает к жизни старые ключи.
+    """
+    invalidate_on_commit(versions=names)
+
+
+def invalidate_on_commit(versions=(), keys=()):
+    """Меняет версии versions и удаляет ключи keys после коммита текущей
+    транзакции, вне транзакции - сразу.
+
+    До коммита другие запросы видят старые данные и закэшировали бы их
+    под новой версией, поэтому внутри транзакции в кэш ничего не пишется.
+    Запрос, изменивший данные, сам эти ключи не читает, так что
+    немедленная запись ради чтения своих изменений не нужна. Всё
+    накопленное за транзакцию записывается одним set_many и одним
+    delete_many.
+    """
+    if not hasattr(pending, "versions"):
+        pending.versions, pending.keys = set(), set()
+    pending.versions.update(versions)
+    pending.keys.update(keys)
+    if connection.in_atomic_block:
+        # Повторные вызовы после первого ничего не делают; после отката
+        # накопленное сбросится со следующим коммитом, что безопасно
+        transaction.on_commit(flush_pending)
+    else:
+        flush_pending()
+
+
+def flush_pending():
+    versions, keys = pending.versions, pending.keys
+    pending.versions, pending.keys = set(), set()
+    if versions:
+        cache.set_many(
+            {VERSION_KEY.format(name): time_ns() for name in versions},
+            timeout=None,
+        )
+    if keys:
+        cache.delete_many(list(keys))
+
+
+def invalidate_recipe_ingredients(recipe_id):
+    """Сбрасывает всё, что зависит от состава ингредиентов рецепта.
+
+    Вызывается сигналами и явно после bulk-операций, которые сигналов
+    не посылают.
+    """
+    bump_version(RECIPE.format(recipe_id), RECIPE_LIST)
+    transaction.on_commit(lambda: recipe_ingredient_changes.append(recipe_id))
+
+
+class ChangeLog:
+    """Журнал изменённых объектов в общем кэше.
+
+    Записи нумеруются подряд: cache.add не даёт двум процессам занять
+    один номер, а head подсказывает, с какого номера искать свободный.
+    Подсказка может отстать, поэтому читатель не доверяет ей, а дочитывает
+    записи до первого незанятого номера. Все номера ниже head когда-то
+    были заняты, так что пропуск ниже head означает потерянную кэшем
+    запись.
+    """
+
+    read_batch = 32
+
+    def __init__(self, name):
+        self.head_key = CHANGES_KEY.format(name)
+
+    def get_key(self, position):
+        return f"{self.head_key}:{position}"
+
+    def head(self):
+        """Номер, с которого следующая запись ищет свободное место."""
+        return cache.get(self.head_key, 0)
+
+    def append(self, value):
+        position = self.head()
+        while not cache.add(self.get_key(position), value, CHANGES_TIMEOUT):
+            position += 1
+        cache.set(self.head_key, position + 1, timeout=None)
+
+    def read(self, position, limit):
+        """Записи с номера position и номер следующей за ними.
+
+        Вместо записей возвращает None, если их больше limit или часть
+        из них потеряна: читателю дешевле загрузить данные заново.
+        """
+        entries = []
+        end = position
+        while len(entries) <= limit:
+            keys = [
+                self.get_key(number)
+                for number in range(end, end + self.read_batch)
+            ]
+            found = cache.get_many(keys)
+            present = list(takewhile(lambda key: key in found, keys))
+            entries.extend(found[key] for key in present)
+            end += len(present)
+            if len(present) < len(keys):
+                break
+        head = self.head()
+        if len(entries) > limit or head < position or head > end:
+            return None, end
+        return entries, end
+
+
+class RecipeIdSet:
+    """Кэш отсортированных id рецептов, связанных с пользователем.
+
+    Множество загружается одним запросом при первом обращении и
+    сбрасывается сигналами при добавлении и удалении связей.
+    """
+
+    def __init__(self, model, prefix):
+        self.model = model
+        self.prefix = prefix
+
+    def get_key(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+    def load(self, user_id):
+        return array(
+            "q",
+            self.model.objects.filter(user_id=user_id)
+            .order_by("recipe_id")
+            .values_list("recipe_id", flat=True),
+        )
+
+    def get(self, user):
+        """Отсортированный array id рецептов пользователя."""
+        if user.is_anonymous:
+            return array("q")
+        key = self.get_key(user.pk)
+        recipe_ids = cache.get(key)
+        if recipe_ids is None:
+            recipe_ids = self.load(user.pk)
+            cache.set(key, recipe_ids, settings.MEMBERSHIP_CACHE_TIMEOUT)
+        return recipe_ids
+
+    def invalidate(self, user_id):
+        """Удаляет закэшированное множество: следующее чтение загрузит его
+        заново. Исправление на месте (чтение, изменение, запись) теряло бы
+        параллельные изменения."""
+        invalidate_on_commit(keys=(self.get_key(user_id),))
+
+
+def contains(recipe_ids, recipe_id):
+    """Проверка вхождения id в отсортированный array."""
+    position = bisect_left(recipe_ids, recipe_id)
+    return position < len(recipe_ids) and recipe_ids[position] == recipe_id
+
+
+recipe_ingredient_changes = ChangeLog("recipe_ingredients")
+favorites = RecipeIdSet(FavoriteRecipe, "favorites")
+shopping_cart = RecipeIdSet(ShoppingList, "shopping_cart")
@@ -0,0 +1,111 @@
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery, Sum
+
+from .models import IngredientInRecipe, ShoppingList, ShoppingListIngredient
+
+REBUILD_BATCH_SIZE = 1000
+
+# Прибавление выполняется одним INSERT ... ON CONFLICT: недостающие строки
+# создаются, существующие увеличиваются. Вычитание - одним UPDATE без
+# вставок, чтобы не создавать строк во время каскадного удаления.
+ADD_RECIPES_SQL = """
+    INSERT INTO {totals} (user_id, ingredient_id, amount)
+    SELECT %s, ingredient_id, SUM(amount) FROM {ingredients}
+    WHERE recipe_id IN ({recipes}) GROUP BY ingredient_id
+    ON CONFLICT (user_id, ingredient_id)
+    DO UPDATE SET amount = {totals}.amount + EXCLUDED.amount
+"""
+ADD_AMOUNT_SQL = """
+    INSERT INTO {totals} (user_id, ingredient_id, amount)
+    SELECT user_id, %s, %s FROM {carts} WHERE recipe_id = %s
+    ON CONFLICT (user_id, ingredient_id)
+    DO UPDATE SET amount = {totals}.amount + EXCLUDED.amount
+"""
+
+
+def format_sql(sql, **kwargs):
+    quote = connection.ops.quote_name
+    return sql.format(
+        totals=quote(ShoppingListIngredient._meta.db_table),
+        ingredients=quote(IngredientInRecipe._meta.db_table),
+        carts=quote(ShoppingList._meta.db_table),
+        **kwargs,
+    )
+
+
+def add_recipe(user_id, recipe_id):
+    """Прибавляет ингредиенты рецепта к списку покупок пользователя."""
+    add_recipes(user_id, [recipe_id])
+
+
+def add_recipes(user_id, recipe_ids):
+    """Прибавляет ингредиенты нескольких рецептов одним запросом."""
+    if not recipe_ids:
+        return
+    sql = format_sql(
+        ADD_RECIPES_SQL, recipes=", ".join(["%s"] * len(recipe_ids))
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user_id, *recipe_ids])
+
+
+def remove_recipe(user_id, recipe_id):
+    """Вычитает ингредиенты рецепта из списка покупок пользователя."""
+    remove_recipes(user_id, [recipe_id])
+
+
+def remove_recipes(user_id, recipe_ids):
+    """Вычитает ингредиенты нескольких рецептов одним запросом."""
+    rows = IngredientInRecipe.objects.filter(recipe_id__in=recipe_ids)
+    totals = (
+        rows.filter(ingredient_id=OuterRef("ingredient_id"))
+        .values("ingredient_id")
+        .annotate(total=Sum("amount"))
+        .values("total")
+    )
+    ShoppingListIngredient.objects.filter(
+        user_id=user_id, ingredient_id__in=rows.values("ingredient_id")
+    ).update(amount=F("amount") - Subquery(totals))
+
+
+def change_amounts(recipe_id, deltas):
+    """Изменяет количества ингредиентов рецепта во всех списках покупок,
+    где он есть; deltas - {id ингредиента: изменение количества}."""
+    added = [
+        [ingredient_id, delta, recipe_id]
+        for ingredient_id, delta in deltas.items()
+        if delta > 0
+    ]
+    if added:
+        with connection.cursor() as cursor:
+            cursor.executemany(format_sql(ADD_AMOUNT_SQL), added)
+    carts = ShoppingList.objects.filter(recipe_id=recipe_id)
+    for ingredient_id, delta in deltas.items():
+        if delta < 0:
+            ShoppingListIngredient.objects.filter(
+                ingredient_id=ingredient_id,
+                user_id__in=carts.values("user_id"),
+            ).update(amount=F("amount") + delta)
+
+
+def expected_totals():
+    """Суммы ингредиентов по спискам покупок, посчитанные заново,
+    упорядоченные по пользователю и ингредиенту."""
+    return (
+        IngredientInRecipe.objects.filter(
+            recipe__shopping_list__isnull=False
+        )
+        .values_list("recipe__shopping_list__user_id", "ingredient_id")
+        .annotate(total=Sum("amount"))
+        .order_by("recipe__shopping_list__user_id", "ingredient_id")
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
+
+
+def stored_totals():
+    return (
+        ShoppingListIngredient.objects.filter(amount__gt=0)
+        .values_list("user_id", "ingredient_id", "amount")
+        .order_by("user_id", "ingredient_id")
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
@@ -1,39 +1,91 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Exists, OuterRef
 from django_filters import rest_framework
-from recipes.models import Ingredient, Recipe
-from rest_framework.filters import SearchFilter
+from recipes.models import FavoriteRecipe, Recipe, ShoppingList
+from recipes.search import ingredient_index, search_recipes, tag_index
+from rest_framework.filters import BaseFilterBackend
 
 User = get_user_model()
 
 
-class IngredientSearch(SearchFilter):
+class IngredientSearch(BaseFilterBackend):
+    """Поиск ингредиентов по началу названия через индекс в памяти."""
+
     search_param = "name"
+    limit_param = "limit"
 
-    class Meta:
-        model = Ingredient
-        fields = ("name",)
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_param])
+        except (KeyError, ValueError):
+            return settings.INGREDIENT_SEARCH_LIMIT
+        return limit if limit > 0 else settings.INGREDIENT_SEARCH_LIMIT
+
+    def filter_queryset(self, request, queryset, view):
+        name = request.query_params.get(self.search_param)
+        if not name or view.action != "list":
+            return queryset
+        return ingredient_index.search(name, self.get_limit(request))
+
+
+def tag_choices():
+    return [(slug, slug) for slug in tag_index.slug_ids()]
 
 
 class RecipeFilter(rest_framework.FilterSet):
     author = rest_framework.ModelChoiceFilter(queryset=User.objects.all())
-    tags = rest_framework.AllValuesMultipleFilter(field_name="tags__slug")
+    tags = rest_framework.MultipleChoiceFilter(
+        choices=tag_choices, method="filter_tags"
+    )
     is_favorited = rest_framework.BooleanFilter(method="filter_is_favorited")
     is_in_shopping_cart = rest_framework.BooleanFilter(
         method="filter_is_in_shopping_cart"
     )
+    search = rest_framework.CharFilter(method="filter_search")
 
-    def filter_is_favorited(self, queryset, name, value):
-        user = self.request.user.pk
-        if value and user:
-            return queryset.filter(favorite__user=user)
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        slug_ids = tag_index.slug_ids()
+        return queryset.filter(
+            Exists(
+                Recipe.tags.through.objects.filter(
+                    recipe=OuterRef("pk"),
+                    tag_id__in=[slug_ids[slug] for slug in value],
+                )
+            )
+        )
+
+    def filter_related(self, queryset, model, value):
+        """Рецепты, связанные с пользователем через model, подзапросом
+        EXISTS: число связей не влияет на размер запроса."""
+        user = self.request.user
+        if value and user.is_authenticated:
+            return queryset.filter(
+                Exists(
+                    model.objects.filter(user=user, recipe_id=OuterRef("pk"))
+                )
+            )
         return queryset
 
+    def filter_is_favorited(self, queryset, name, value):
+        return self.filter_related(queryset, FavoriteRecipe, value)
+
     def filter_is_in_shopping_cart(self, queryset, name, value):
-        user = self.request.user.pk
-        if value and user:
-            return queryset.filter(shopping_list__user=user)
+        return self.filter_related(queryset, ShoppingList, value)
+
+    def filter_search(self, queryset, name, value):
+        if value.strip():
+            return search_recipes(queryset, value)
         return queryset
 
     class Meta:
         model = Recipe
-        fields = ("author", "tags", "is_favorited", "is_in_shopping_cart")
+        fields = (
+            "author",
+            "tags",
+            "is_favorited",
+            "is_in_shopping_cart",
+            "search",
+        )
@@ -0,0 +1,96 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from PIL import Image, ImageOps
+
+from .cache import RECIPE, RECIPE_LIST, bump_version
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = {
+    "thumbnail": (160, 160),
+    "card": (480, 480),
+    "full": (1280, 1280),
+}
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+VARIANTS_DIR = "recipes/variants/"
+QUALITY = 82
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_VARIANT_WORKERS,
+    thread_name_prefix="image-variants",
+)
+
+
+def variant_name(image_name, variant, extension):
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    return f"{VARIANTS_DIR}{stem}_{variant}.{extension}"
+
+
+def has_variants(recipe):
+    """Построены ли варианты для текущего изображения рецепта."""
+    return recipe.image_variants.get("source") == recipe.image.name
+
+
+def render_variants(image_name):
+    """Уменьшенные копии изображения в WebP и JPEG.
+
+    Возвращает {"source": исходный файл, вариант: {формат: файл}}.
+    """
+    with default_storage.open(image_name) as file:
+        original = ImageOps.exif_transpose(Image.open(file)).convert("RGB")
+    variants = {"source": image_name}
+    for variant, size in VARIANTS.items():
+        image = original.copy()
+        image.thumbnail(size, Image.LANCZOS)
+        variants[variant] = {}
+        for extension, image_format in FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, image_format, quality=QUALITY)
+            variants[variant][extension] = default_storage.save(
+                variant_name(image_name, variant, extension),
+                ContentFile(buffer.getvalue()),
+            )
+    return variants
+
+
+def build_variants(recipe_id, image_name):
+    """Строит варианты и сохраняет их у рецепта, если изображение
+    за это время не заменили.
+
+    Выполняется в потоке пула, у которого своё соединение с базой: оно
+    закрывается после каждой задачи, как после запроса.
+    """
+    close_old_connections()
+    try:
+        save_variants(recipe_id, image_name)
+    finally:
+        connection.close()
+
+
+def save_variants(recipe_id, image_name):
+    try:
+        variants = render_variants(image_name)
+    except Exception:
+        logger.exception("Не удалось обработать изображение %s", image_name)
+        return
+    updated = Recipe.objects.filter(pk=recipe_id, image=image_name).update(
+        image_variants=variants
+    )
+    if updated:
+        bump_version(RECIPE.format(recipe_id), RECIPE_LIST)
+
+
+def schedule_variants(recipe):
+    """Ставит построение вариантов в фоновый пул после коммита."""
+    recipe_id, image_name = recipe.pk, recipe.image.name
+    transaction.on_commit(
+        lambda: executor.submit(build_variants, recipe_id, image_name)
+    )
@@ -0,0 +1,134 @@
+import os
+import shutil
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from recipes.images import FORMATS, VARIANTS, VARIANTS_DIR
+from recipes.models import Recipe
+
+CHUNK_SIZE = 2000
+
+
+def referenced_names(names):
+    """Имена из names, на которые ссылается изображение или вариант
+    изображения какого-либо рецепта.
+
+    Каждое поле проверяется отдельным запросом, чтобы список имён
+    передавался в запрос один раз и пачка не упиралась в предел числа
+    параметров запроса.
+    """
+    referenced = set(
+        Recipe.objects.filter(image__in=names).values_list("image", flat=True)
+    )
+    for variant in VARIANTS:
+        for extension in FORMATS:
+            field = f"image_variants__{variant}__{extension}"
+            referenced.update(
+                Recipe.objects.filter(**{f"{field}__in": names}).values_list(
+                    field, flat=True
+                )
+            )
+    return referenced
+
+
+def scan(directory):
+    """Файлы каталога хранилища по одному, без полного списка в памяти."""
+    path = default_storage.path(directory)
+    if not os.path.isdir(path):
+        return
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                yield directory + entry.name, entry.stat()
+
+
+class Command(BaseCommand):
+    help = (
+        "Удаляет изображения рецептов и их варианты, на которые не "
+        "ссылается ни один рецепт."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Только показать, что будет удалено.",
+        )
+        parser.add_argument(
+            "--quarantine",
+            metavar="DIR",
+            help="Переместить файлы в каталог DIR вместо удаления.",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help=(
+                "Не трогать файлы моложе стольких секунд: они могут "
+                "принадлежать ещё не сохранённому рецепту."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help="Размер пачки файлов, проверяемых одним запросом.",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        self.quarantine = options["quarantine"]
+        batch_size = options["batch_size"]
+        self.modified_before = time.time() - options["min_age"]
+        directories = (
+            Recipe._meta.get_field("image").upload_to,
+            VARIANTS_DIR,
+        )
+        self.files = self.reclaimed = 0
+        batch = {}
+        for directory in directories:
+            for name, stat in scan(directory):
+                if stat.st_mtime > self.modified_before:
+                    continue
+                batch[name] = stat.st_size
+                if len(batch) >= batch_size:
+                    self.remove(batch)
+                    batch = {}
+        self.remove(batch)
+        action = "Будет освобождено" if self.dry_run else "Освобождено"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{action} {self.reclaimed} байт, файлов: {self.files}"
+            )
+        )
+
+    def remove(self, sizes):
+        """Удаляет файлы пачки, на которые нет ссылок.
+
+        Ссылки проверяются непосредственно перед удалением, а сохранение
+        уже существующего файла обновляет его mtime, поэтому файл, ставший
+        нужным после сканирования, не удаляется.
+        """
+        if not sizes:
+            return
+        referenced = referenced_names(list(sizes))
+        for name, size in sizes.items():
+            if name in referenced:
+                continue
+            path = default_storage.path(name)
+            try:
+                if os.stat(path).st_mtime > self.modified_before:
+                    continue
+            except FileNotFoundError:
+                continue
+            self.files += 1
+            self.reclaimed += size
+            if self.dry_run:
+                self.stdout.write(name)
+            elif self.quarantine:
+                target = os.path.join(self.quarantine, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+            else:
+                default_storage.delete(name)
@@ -3,6 +3,7 @@ import os
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from recipes.cache import INGREDIENTS, RECIPES, bump_version
 from recipes.models import Ingredient
 
 
@@ -19,4 +20,5 @@ class Command(BaseCommand):
                     name=row[0], measurement_unit=row[1]
                 )
                 counter += 1
+        bump_version(INGREDIENTS, RECIPES)
         print(f"В базу данных успешно добавлены ингредиенты - {counter} шт. ✅")
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from recipes.cart import REBUILD_BATCH_SIZE, expected_totals, stored_totals
+from recipes.models import ShoppingListIngredient
+
+
+def differences(expected, stored):
+    """Число расхождений двух упорядоченных по (пользователь, ингредиент)
+    потоков строк (пользователь, ингредиент, количество)."""
+    count = 0
+    expected, stored = iter(expected), iter(stored)
+    left, right = next(expected, None), next(stored, None)
+    while left is not None or right is not None:
+        if right is None or (left is not None and left[:2] < right[:2]):
+            count += 1
+            left = next(expected, None)
+        elif left is None or right[:2] < left[:2]:
+            count += 1
+            right = next(stored, None)
+        else:
+            count += left[2] != right[2]
+            left, right = next(expected, None), next(stored, None)
+    return count
+
+
+class Command(BaseCommand):
+    help = (
+        "Сверяет суммы ингредиентов в списках покупок с рецептами "
+        "и пересчитывает их при расхождении."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Только проверить, завершиться с ошибкой при расхождении.",
+        )
+
+    def handle(self, *args, **options):
+        count = differences(expected_totals(), stored_totals())
+        if not count:
+            self.stdout.write(self.style.SUCCESS("Расхождений нет"))
+            return
+        if options["check"]:
+            raise CommandError(f"Расхождений: {count}")
+        with transaction.atomic():
+            ShoppingListIngredient.objects.all().delete()
+            ShoppingListIngredient.objects.bulk_create(
+                (
+                    ShoppingListIngredient(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        amount=total,
+                    )
+                    for user_id, ingredient_id, total in expected_totals()
+                ),
+                batch_size=REBUILD_BATCH_SIZE,
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Исправлено расхождений: {count}")
+        )
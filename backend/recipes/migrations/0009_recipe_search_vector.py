@@ -0,0 +1,44 @@
+# Generated by Django 3.2.19 on 2026-10-18 02:57
+
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+INDEX_NAME = "recipe_search_vector_gin"
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    Recipe = apps.get_model("recipes", "Recipe")
+    Recipe.objects.update(
+        search_vector=SearchVector("name", weight="A", config="russian")
+        + SearchVector("text", weight="B", config="russian")
+    )
+    schema_editor.execute(
+        f"CREATE INDEX {INDEX_NAME} ON {Recipe._meta.db_table} "
+        "USING gin (search_vector)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("recipes", "0008_auto_20230526_1921"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="recipe",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True, verbose_name="Поисковый вектор"
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,12 +1,16 @@
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.functions import RowNumber
 
 User = get_user_model()
 
 MAX_LEN = 200
 HEX_LEN = 7
 DEFAULT_HEX = "2c3cba"
+# Поля рецепта, которые нужны для его краткого представления
+RECIPE_PAGE_FIELDS = ("id", "name", "image", "image_variants", "cooking_time")
 
 
 class Ingredient(models.Model):
@@ -44,9 +48,51 @@ class Tag(models.Model):
         return f"{self.name}"
 
 
+class RecipeQuerySet(models.QuerySet):
+    def latest_per_author(self, limit):
+        """Не больше limit самых новых рецептов каждого автора одним
+        запросом с ROW_NUMBER() OVER (PARTITION BY author_id)."""
+        ranked = (
+            self.only(*RECIPE_PAGE_FIELDS, "author_id")
+            .annotate(
+                recipe_rank=models.Window(
+                    RowNumber(),
+                    partition_by=models.F("author_id"),
+                    order_by=(
+                        models.F("pub_date").desc(),
+                        models.F("id").desc(),
+                    ),
+                )
+            )
+            .order_by()
+        )
+        sql, params = ranked.query.sql_with_params()
+        return self.model.objects.raw(
+            f"SELECT * FROM ({sql}) ranked WHERE recipe_rank <= %s "
+            "ORDER BY author_id, recipe_rank",
+            (*params, limit),
+        )
+
+    @staticmethod
+    def related_lookups():
+        """Связи рецепта, подгружаемые через prefetch_related."""
+        return (
+            "tags",
+            models.Prefetch(
+                "recipeingredients",
+                queryset=IngredientInRecipe.objects.select_related(
+                    "ingredient"
+                ),
+            ),
+        )
+
+
 class Recipe(models.Model):
     name = models.CharField("Название рецепта", max_length=MAX_LEN)
     image = models.ImageField("Изображение", upload_to="recipes/images/")
+    image_variants = models.JSONField(
+        "Варианты изображения", default=dict, editable=False
+    )
     text = models.TextField("Описание")
     author = models.ForeignKey(
         User,
@@ -75,11 +121,27 @@ class Recipe(models.Model):
     pub_date = models.DateTimeField(
         verbose_name="Дата публикации", auto_now_add=True
     )
+    search_vector = SearchVectorField(
+        "Поисковый вектор", null=True, editable=False
+    )
+    fanned_out = models.BooleanField(
+        "Разослан по лентам подписчиков", default=False, editable=False
+    )
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ("-pub_date",)
         verbose_name = "Рецепт"
         verbose_name_plural = "Рецепты"
+        indexes = (
+            # Рецепты, которые лента подписчика добирает при чтении
+            models.Index(
+                fields=("author", "-pub_date", "-id"),
+                condition=models.Q(fanned_out=False),
+                name="recipe_not_fanned_out_idx",
+            ),
+        )
 
     def __str__(self):
         return f"{self.name} ({self.author})"
@@ -146,6 +208,77 @@ class ShoppingList(models.Model):
         return f"{self.user} added {self.recipe}"
 
 
+class ShoppingListIngredient(models.Model):
+    """Суммарное количество ингредиента в списке покупок пользователя.
+
+    Поддерживается при изменении списка покупок и ингредиентов рецептов,
+    строки с нулевым количеством не выводятся.
+    """
+
+    user = models.ForeignKey(
+        User,
+        verbose_name="Пользователь",
+        on_delete=models.CASCADE,
+        related_name="shopping_list_ingredients",
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name="Ингредиент",
+        on_delete=models.CASCADE,
+        related_name="shopping_list_totals",
+    )
+    amount = models.IntegerField("Количество")
+
+    class Meta:
+        verbose_name = "Ингредиент в списке покупок"
+        verbose_name_plural = "Ингредиенты в списках покупок"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("user", "ingredient"),
+                name="unique_shopping_list_ingredient",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.ingredient} - {self.amount}"
+
+
+class TimelineEntry(models.Model):
+    """Рецепт в ленте подписок пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        verbose_name="Пользователь",
+        on_delete=models.CASCADE,
+        related_name="timeline_entries",
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        verbose_name="Рецепт",
+        on_delete=models.CASCADE,
+        related_name="timeline_entries",
+    )
+    pub_date = models.DateTimeField("Дата публикации")
+
+    class Meta:
+        verbose_name = "Запись ленты"
+        verbose_name_plural = "Записи ленты"
+        constraints = [
+            models.UniqueConstraint(
+                fields=("user", "recipe"), name="unique_timeline_entry"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=("user", "-pub_date", "-recipe"),
+                name="timeline_entry_page",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.recipe}"
+
+
 class FavoriteRecipe(models.Model):
     """Модель для понравившихся рецептов."""
 
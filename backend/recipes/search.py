@@ -0,0 +1,307 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from heapq import merge
+from itertools import groupby
+from operator import itemgetter
+from threading import Lock
+
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections
+from django.db.models import (Case, F, Func, IntegerField, Q, TextField, Value,
+                              When)
+
+from .cache import (INGREDIENTS, RECIPE_ORDER, TAGS, get_version,
+                    recipe_ingredient_changes)
+from .models import Ingredient, IngredientInRecipe, Recipe, Tag
+
+SEARCH_CONFIG = "russian"
+# Больше изменений дешевле прочитать перестройкой индекса
+INDEX_MAX_CHANGES = 500
+
+
+def normalize(text):
+    """Приводит строку к виду для сравнения без учёта регистра и ё/е."""
+    return text.strip().casefold().replace("ё", "е")
+
+
+def normalize_sql(text):
+    """normalize для SQL-функции NORMALIZE в SQLite."""
+    return None if text is None else normalize(text)
+
+
+class Normalize(Func):
+    """Строка в виде normalize. LOWER в SQLite меняет регистр только
+    латиницы, поэтому функция регистрируется для каждого соединения."""
+
+    function = "NORMALIZE"
+    output_field = TextField()
+
+
+class VersionedIndex:
+    """Структура в памяти процесса, перестраиваемая при смене версии.
+
+    Данные индекса заменяются целиком одним присваиванием, поэтому
+    читающие потоки не видят частично построенного состояния.
+    Подклассы задают version_name и queryset - строки, из которых
+    build строит индекс.
+    """
+
+    version_name = None
+    queryset = None
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.data = None
+
+    def rows(self):
+        return self.queryset.all().iterator()
+
+    def build(self):
+        return list(self.rows())
+
+    def refresh(self):
+        version = get_version(self.version_name)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.data = self.build()
+                    self.version = version
+        return self.data
+
+
+class IngredientIndex(VersionedIndex):
+    """Индекс ингредиентов для поиска по префиксу.
+
+    Названия хранятся отсортированными в нормализованном виде, все
+    совпадения с префиксом занимают непрерывный диапазон, который
+    находится двоичным поиском.
+    """
+
+    version_name = INGREDIENTS
+    queryset = Ingredient.objects.all()
+
+    def build(self):
+        ingredients = sorted(
+            self.rows(),
+            key=lambda ingredient: (normalize(ingredient.name), ingredient.id),
+        )
+        keys = [normalize(ingredient.name) for ingredient in ingredients]
+        return keys, ingredients
+
+    def search(self, prefix, limit):
+        """Первые limit ингредиентов, название которых начинается с prefix."""
+        keys, ingredients = self.refresh()
+        prefix = normalize(prefix)
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + "\uffff", start)
+        return ingredients[start:min(end, start + limit)]
+
+
+class TagIndex(VersionedIndex):
+    """Соответствие slug тега его id."""
+
+    version_name = TAGS
+    queryset = Tag.objects.values_list("slug", "id")
+
+    def build(self):
+        return dict(self.rows())
+
+    def slug_ids(self):
+        return self.refresh()
+
+
+class RecipeListIndex(VersionedIndex):
+    """Упорядоченные по дате публикации id всех рецептов и рецептов
+    каждого тега.
+
+    Рецепты тега хранятся как возрастающие позиции в общем списке,
+    поэтому выборка по нескольким тегам - слияние отсортированных
+    массивов без повторов.
+    """
+
+    version_name = RECIPE_ORDER
+    # Рецепты и их теги читаются одним запросом, чтобы список и
+    # позиции в нём были согласованы между собой.
+    queryset = Recipe.objects.order_by("-pub_date", "-id").values_list(
+        "id", "tags__id"
+    )
+
+    def build(self):
+        ordered = array("q")
+        by_tag = defaultdict(list)
+        for recipe_id, recipe_rows in groupby(
+            self.rows(), key=itemgetter(0)
+        ):
+            position = len(ordered)
+            ordered.append(recipe_id)
+            for _, tag_id in recipe_rows:
+                if tag_id is not None:
+                    by_tag[tag_id].append(position)
+        return ordered, {
+            tag_id: array("q", sorted(tag_positions))
+            for tag_id, tag_positions in by_tag.items()
+        }
+
+    def recipe_ids(self, slugs):
+        """id рецептов с любым из тегов slugs (всех, если slugs пуст)
+        в порядке выдачи; None, если какого-то тега нет."""
+        slug_ids = tag_index.slug_ids()
+        if any(slug not in slug_ids for slug in slugs):
+            return None
+        ordered, by_tag = self.refresh()
+        if not slugs:
+            return ordered
+        merged = merge(*(by_tag.get(slug_ids[slug], ()) for slug in slugs))
+        return [ordered[position] for position, _ in groupby(merged)]
+
+
+class RecipeIngredientIndex(VersionedIndex):
+    """Обратный индекс: id ингредиента -> id рецептов, где он используется.
+
+    Вместе с составом каждого рецепта позволяет за один проход по спискам
+    выбранных ингредиентов посчитать, чего не хватает каждому рецепту.
+    Изменённые рецепты берутся из журнала recipe_ingredient_changes,
+    и перечитываются только их ингредиенты.
+    """
+
+    queryset = IngredientInRecipe.objects.order_by("recipe_id").values_list(
+        "recipe_id", "ingredient_id"
+    )
+    changes = recipe_ingredient_changes
+
+    def __init__(self):
+        super().__init__()
+        self.position = None
+
+    def build(self):
+        postings = defaultdict(lambda: array("q"))
+        ingredients = {}
+        for recipe_id, recipe_rows in groupby(
+            self.rows(), key=itemgetter(0)
+        ):
+            ingredients[recipe_id] = array(
+                "q", (ingredient_id for _, ingredient_id in recipe_rows)
+            )
+            for ingredient_id in ingredients[recipe_id]:
+                postings[ingredient_id].append(recipe_id)
+        return dict(postings), ingredients
+
+    def update(self, data, recipe_ids):
+        """Копия индекса, в которой заново прочитан состав recipe_ids."""
+        postings, ingredients = dict(data[0]), dict(data[1])
+        updated = defaultdict(lambda: array("q"))
+        rows = self.queryset.filter(recipe_id__in=recipe_ids)
+        for recipe_id, ingredient_id in rows:
+            updated[recipe_id].append(ingredient_id)
+        affected = set()
+        for recipe_id in recipe_ids:
+            affected.update(ingredients.pop(recipe_id, ()))
+            if recipe_id in updated:
+                ingredients[recipe_id] = updated[recipe_id]
+                affected.update(updated[recipe_id])
+        for ingredient_id in affected:
+            posting = set(postings.get(ingredient_id, ())) - recipe_ids
+            posting.update(
+                recipe_id
+                for recipe_id in recipe_ids
+                if ingredient_id in updated.get(recipe_id, ())
+            )
+            if posting:
+                postings[ingredient_id] = array("q", sorted(posting))
+            else:
+                postings.pop(ingredient_id, None)
+        return postings, ingredients
+
+    def refresh(self):
+        position = self.position
+        changed = None
+        if position is not None:
+            changed, head = self.changes.read(position, INDEX_MAX_CHANGES)
+            if changed == []:
+                return self.data
+        with self.lock:
+            if self.position == position:
+                if changed is None:
+                    head = self.changes.head()
+                    self.data = self.build()
+                else:
+                    self.data = self.update(self.data, set(changed))
+                self.position = head
+        return self.data
+
+    def match(self, ingredient_ids, max_missing):
+        """Пары (id рецепта, число недостающих ингредиентов).
+
+        Сначала рецепты, которым ничего не нужно, затем с одним, двумя
+        и т.д. недостающими ингредиентами, при равенстве - более новые.
+        """
+        postings, ingredients = self.refresh()
+        matched = Counter()
+        for ingredient_id in set(ingredient_ids):
+            matched.update(postings.get(ingredient_id, ()))
+        results = [
+            (len(ingredients[recipe_id]) - count, -recipe_id)
+            for recipe_id, count in matched.items()
+            if len(ingredients[recipe_id]) - count <= max_missing
+        ]
+        results.sort()
+        return [(-recipe_id, missing) for missing, recipe_id in results]
+
+
+ingredient_index = IngredientIndex()
+tag_index = TagIndex()
+recipe_list_index = RecipeListIndex()
+recipe_ingredient_index = RecipeIngredientIndex()
+
+
+def recipe_search_vector():
+    """Вектор полнотекстового поиска: название весомее описания."""
+    return SearchVector(
+        "name", weight="A", config=SEARCH_CONFIG
+    ) + SearchVector("text", weight="B", config=SEARCH_CONFIG)
+
+
+def uses_full_text_search(queryset):
+    return connections[queryset.db].vendor == "postgresql"
+
+
+def update_recipe_search_vector(recipe):
+    recipes = Recipe.objects.filter(pk=recipe.pk)
+    if uses_full_text_search(recipes):
+        recipes.update(search_vector=recipe_search_vector())
+
+
+def search_recipes(queryset, text):
+    """Рецепты, подходящие под запрос text, по убыванию релевантности.
+
+    В PostgreSQL поиск идёт по индексированному search_vector, в других
+    базах (SQLite при разработке) - по вхождению всех слов запроса
+    в название или описание без учёта регистра и ё/е.
+    """
+    if uses_full_text_search(queryset):
+        query = SearchQuery(
+            text, config=SEARCH_CONFIG, search_type="websearch"
+        )
+        return (
+            queryset.filter(search_vector=query)
+            .annotate(rank=SearchRank(F("search_vector"), query))
+            .order_by("-rank", "-pub_date", "-id")
+        )
+    queryset = queryset.annotate(
+        normalized_name=Normalize("name"), normalized_text=Normalize("text")
+    )
+    for word in normalize(text).split():
+        queryset = queryset.filter(
+            Q(normalized_name__contains=word)
+            | Q(normalized_text__contains=word)
+        )
+    return queryset.annotate(
+        rank=Case(
+            When(normalized_name__contains=normalize(text), then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    ).order_by("-rank", "-pub_date", "-id")
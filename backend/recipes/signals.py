@@ -0,0 +1,275 @@
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+from users.models import Subscription
+
+from . import cart, timeline
+from .cache import (INGREDIENTS, RECIPE, RECIPE_LIST, RECIPE_ORDER, RECIPES,
+                    TAGS, USER, bump_version, favorites,
+                    invalidate_recipe_ingredients, shopping_cart)
+from .images import has_variants, schedule_variants
+from .models import (FavoriteRecipe, Ingredient, IngredientInRecipe, Recipe,
+                     ShoppingList, Tag)
+from .search import normalize_sql, update_recipe_search_vector
+
+User = get_user_model()
+
+COUNTS = "counts"
+
+MEMBERSHIP = {FavoriteRecipe: favorites, ShoppingList: shopping_cart}
+
+INSERT_SQL = """
+    INSERT INTO {table} (user_id, recipe_id)
+    SELECT %s, id FROM {recipes_table} WHERE id IN ({recipes})
+    ON CONFLICT (user_id, recipe_id) DO NOTHING RETURNING recipe_id
+"""
+DELETE_SQL = (
+    "DELETE FROM {table} WHERE user_id = %s AND recipe_id IN ({recipes})"
+)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+@receiver(post_save, sender=FavoriteRecipe)
+@receiver(post_delete, sender=FavoriteRecipe)
+@receiver(post_save, sender=ShoppingList)
+@receiver(post_delete, sender=ShoppingList)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_counts(**kwargs):
+    bump_version(COUNTS)
+
+
+@receiver(post_save, sender=FavoriteRecipe)
+@receiver(post_save, sender=ShoppingList)
+def add_membership(sender, instance, created, **kwargs):
+    bump_version(USER.format(instance.user_id))
+    if created:
+        MEMBERSHIP[sender].invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=FavoriteRecipe)
+@receiver(post_delete, sender=ShoppingList)
+def remove_membership(sender, instance, **kwargs):
+    bump_version(USER.format(instance.user_id))
+    MEMBERSHIP[sender].invalidate(instance.user_id)
+
+
+def bulk_added(model, user_id, recipe_ids):
+    """То же, что делают сигналы post_save для строк избранного или
+    списка покупок, вставленных без сигналов."""
+    if not recipe_ids:
+        return
+    bump_version(COUNTS, USER.format(user_id))
+    MEMBERSHIP[model].invalidate(user_id)
+    if model is ShoppingList:
+        cart.add_recipes(user_id, recipe_ids)
+
+
+def bulk_insert(model, user_id, recipe_ids):
+    """Добавляет рецепты в избранное или список покупок одним INSERT
+    и делает работу post_save только для действительно вставленных строк.
+
+    bulk_create(ignore_conflicts=True) не сообщает, какие строки
+    пропущены, а строку мог успеть вставить параллельный запрос.
+    Возвращает id добавленных рецептов в порядке recipe_ids.
+    """
+    if not recipe_ids:
+        return []
+    quote = connection.ops.quote_name
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                INSERT_SQL.format(
+                    table=quote(model._meta.db_table),
+                    recipes_table=quote(Recipe._meta.db_table),
+                    recipes=", ".join(["%s"] * len(recipe_ids)),
+                ),
+                [user_id, *recipe_ids],
+            )
+            inserted = {row[0] for row in cursor.fetchall()}
+        added = [pk for pk in recipe_ids if pk in inserted]
+        bulk_added(model, user_id, added)
+    return added
+
+
+def bulk_delete(model, user_id, recipe_ids):
+    """Удаляет рецепты из избранного или списка покупок одним DELETE
+    без сигналов и делает работу post_delete только для действительно
+    удалённых строк.
+
+    QuerySet.delete() отправляет сигналы для всех найденных строк, даже
+    если их уже удалил параллельный запрос, и суммы списка покупок
+    уменьшились бы дважды. Возвращает id удалённых рецептов.
+    """
+    with transaction.atomic():
+        if len(recipe_ids) > 1:
+            # Блокировка строк, чтобы удалить ровно найденные
+            recipe_ids = list(
+                model.objects.select_for_update()
+                .filter(user_id=user_id, recipe_id__in=recipe_ids)
+                .values_list("recipe_id", flat=True)
+            )
+        if not recipe_ids:
+            return []
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                DELETE_SQL.format(
+                    table=quote(model._meta.db_table),
+                    recipes=", ".join(["%s"] * len(recipe_ids)),
+                ),
+                [user_id, *recipe_ids],
+            )
+            if not cursor.rowcount:
+                return []
+        bump_version(COUNTS, USER.format(user_id))
+        MEMBERSHIP[model].invalidate(user_id)
+        if model is ShoppingList:
+            cart.remove_recipes(user_id, recipe_ids)
+    return recipe_ids
+
+
+@receiver(post_save, sender=Recipe)
+def invalidate_recipe(sender, instance, created, **kwargs):
+    if created:
+        bump_version(RECIPE.format(instance.pk), RECIPE_LIST, RECIPE_ORDER)
+    else:
+        bump_version(RECIPE.format(instance.pk), RECIPE_LIST)
+
+
+@receiver(post_delete, sender=Recipe)
+def invalidate_deleted_recipe(sender, instance, **kwargs):
+    bump_version(RECIPE.format(instance.pk), RECIPE_LIST, RECIPE_ORDER)
+
+
+@receiver(post_save, sender=IngredientInRecipe)
+@receiver(post_delete, sender=IngredientInRecipe)
+def invalidate_ingredients_of_recipe(sender, instance, **kwargs):
+    invalidate_recipe_ingredients(instance.recipe_id)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags(instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        bump_version(RECIPE.format(instance.pk), RECIPE_LIST, RECIPE_ORDER)
+    elif pk_set:
+        bump_version(
+            RECIPE_LIST, RECIPE_ORDER, *(RECIPE.format(pk) for pk in pk_set)
+        )
+    else:
+        bump_version(RECIPES, RECIPE_ORDER)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tags(**kwargs):
+    bump_version(TAGS, RECIPES)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_ingredients(**kwargs):
+    bump_version(INGREDIENTS, RECIPES)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_all_recipes(**kwargs):
+    bump_version(RECIPES)
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_recipes(sender, instance, created, **kwargs):
+    if created:
+        return
+    recipe_ids = Recipe.objects.filter(author=instance).values_list(
+        "id", flat=True
+    )
+    bump_version(RECIPE_LIST, *(RECIPE.format(pk) for pk in recipe_ids))
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_subscriber(sender, instance, **kwargs):
+    bump_version(USER.format(instance.subscriber_id))
+
+
+@receiver(post_save, sender=Recipe)
+def update_search_vector(sender, instance, **kwargs):
+    update_recipe_search_vector(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def build_image_variants(sender, instance, **kwargs):
+    if instance.image and not has_variants(instance):
+        schedule_variants(instance)
+
+
+@receiver(post_save, sender=ShoppingList)
+def add_to_cart_totals(sender, instance, created, **kwargs):
+    if created:
+        cart.add_recipe(instance.user_id, instance.recipe_id)
+
+
+@receiver(post_delete, sender=ShoppingList)
+def remove_from_cart_totals(sender, instance, **kwargs):
+    cart.remove_recipe(instance.user_id, instance.recipe_id)
+
+
+@receiver(pre_save, sender=IngredientInRecipe)
+def remember_cart_amount(sender, instance, **kwargs):
+    instance._saved_amount = (
+        IngredientInRecipe.objects.filter(pk=instance.pk)
+        .values_list("ingredient_id", "amount")
+        .first()
+        if instance.pk
+        else None
+    )
+
+
+@receiver(post_save, sender=IngredientInRecipe)
+def update_cart_amounts(sender, instance, **kwargs):
+    deltas = {instance.ingredient_id: instance.amount}
+    saved = getattr(instance, "_saved_amount", None)
+    if saved is not None:
+        ingredient_id, amount = saved
+        deltas[ingredient_id] = deltas.get(ingredient_id, 0) - amount
+    cart.change_amounts(instance.recipe_id, deltas)
+
+
+@receiver(post_delete, sender=IngredientInRecipe)
+def subtract_cart_amount(sender, instance, **kwargs):
+    cart.change_amounts(
+        instance.recipe_id, {instance.ingredient_id: -instance.amount}
+    )
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(sender, instance, created, **kwargs):
+    if created:
+        timeline.fan_out(instance)
+
+
+@receiver(post_save, sender=Subscription)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created:
+        timeline.backfill(instance.subscriber_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Subscription)
+def prune_timeline(sender, instance, **kwargs):
+    timeline.prune(instance.subscriber_id, instance.author_id)
+
+
+@receiver(connection_created)
+def register_normalize(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        connection.connection.create_function("NORMALIZE", 1, normalize_sql)
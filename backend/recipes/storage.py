@@ -0,0 +1,79 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+HASH_LENGTH = 32
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Файловое хранилище, в котором имя файла - хэш его содержимого.
+
+    Одинаковые файлы хранятся один раз: повторное сохранение того же
+    содержимого не пишет на диск и возвращает имя уже сохранённого файла.
+    Содержимое по имени никогда не меняется, поэтому ссылки на файлы
+    можно кэшировать без ограничения срока.
+    """
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(
+            directory, digest.hexdigest()[:HASH_LENGTH] + extension
+        )
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            # Свежий mtime защищает файл от delete_orphaned_media, пока
+            # ссылка на него ещё не сохранена в базе.
+            os.utime(self.path(name))
+            return name
+        return super().save(name, content, max_length)
+
+    def _save(self, name, content):
+        """Пишет файл во временный рядом и публикует его жёсткой ссылкой.
+
+        Ссылка не перезаписывает существующий файл, а читатели не видят
+        недописанного. Если параллельная загрузка того же содержимого
+        успела первой, файл с этим хэшем уже тот же самый: возвращается
+        его имя, а не новое имя от get_available_name.
+        """
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=directory, prefix=".upload-"
+        )
+        try:
+            if hasattr(content, "temporary_file_path"):
+                os.close(descriptor)
+                file_move_safe(
+                    content.temporary_file_path(),
+                    temporary_path,
+                    allow_overwrite=True,
+                )
+            else:
+                with os.fdopen(descriptor, "wb") as file:
+                    for chunk in content.chunks():
+                        file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            try:
+                os.link(temporary_path, full_path)
+            except FileExistsError:
+                os.utime(full_path)
+        finally:
+            os.unlink(temporary_path)
+        return name
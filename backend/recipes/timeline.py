@@ -0,0 +1,104 @@
+from heapq import merge
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from users.models import Subscription
+
+from .models import Recipe, TimelineEntry
+
+# Рецепт раскладывается по лентам всех подписчиков автора одним запросом
+FAN_OUT_SQL = """
+    INSERT INTO {entries} (user_id, recipe_id, pub_date)
+    SELECT subscriber_id, %s, %s FROM {subscriptions} WHERE author_id = %s
+    ON CONFLICT (user_id, recipe_id) DO NOTHING
+"""
+
+
+def followers_count(author_id):
+    return Subscription.objects.filter(author_id=author_id).count()
+
+
+def fan_out(recipe):
+    """Добавляет новый рецепт в ленты подписчиков автора, если их
+    не больше TIMELINE_FANOUT_LIMIT, и отмечает это у рецепта.
+
+    Неразосланные рецепты подписчики добирают при чтении ленты, сколько
+    бы подписчиков ни было у автора к тому времени.
+    """
+    if followers_count(recipe.author_id) > settings.TIMELINE_FANOUT_LIMIT:
+        return
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            FAN_OUT_SQL.format(
+                entries=quote(TimelineEntry._meta.db_table),
+                subscriptions=quote(Subscription._meta.db_table),
+            ),
+            [recipe.id, recipe.pub_date, recipe.author_id],
+        )
+    Recipe.objects.filter(pk=recipe.pk).update(fanned_out=True)
+    recipe.fanned_out = True
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту последние разосланные рецепты автора после
+    подписки; остальные лента добирает при чтении."""
+    recipes = Recipe.objects.filter(
+        author_id=author_id, fanned_out=True
+    ).values_list("id", "pub_date")[:settings.TIMELINE_BACKFILL]
+    TimelineEntry.objects.bulk_create(
+        (
+            TimelineEntry(user_id=user_id, recipe_id=pk, pub_date=pub_date)
+            for pk, pub_date in recipes
+        ),
+        ignore_conflicts=True,
+    )
+
+
+def prune(user_id, author_id):
+    """Убирает из ленты рецепты автора после отписки."""
+    TimelineEntry.objects.filter(
+        user_id=user_id, recipe__author_id=author_id
+    ).delete()
+
+
+def after(values, id_field):
+    """Условие «строго после» курсора (pub_date, id) при сортировке
+    по убыванию."""
+    if values is None:
+        return Q()
+    pub_date, pk = values
+    return Q(pub_date__lt=pub_date) | Q(
+        pub_date=pub_date, **{f"{id_field}__lt": pk}
+    )
+
+
+def recipe_keys(user, cursor, limit):
+    """Ключи (pub_date, id) первых limit рецептов ленты после cursor.
+
+    Рецепты из ленты пользователя сливаются с неразосланными рецептами
+    авторов, на которых он подписан.
+    """
+    inbox = (
+        TimelineEntry.objects.filter(after(cursor, "recipe_id"), user=user)
+        .order_by("-pub_date", "-recipe_id")
+        .values_list("pub_date", "recipe_id")[:limit]
+    )
+    authors = Subscription.objects.filter(subscriber=user).values(
+        "author_id"
+    )
+    pulled = (
+        Recipe.objects.filter(
+            after(cursor, "id"), author_id__in=authors, fanned_out=False
+        )
+        .order_by("-pub_date", "-id")
+        .values_list("pub_date", "id")[:limit]
+    )
+    keys = []
+    seen = set()
+    for key in merge(inbox, pulled, reverse=True):
+        if key[1] not in seen:
+            seen.add(key[1])
+            keys.append(key)
+    return keys[:limit]